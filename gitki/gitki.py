@@ -1,11 +1,74 @@
-import ansi2html
+import collections
+import contextlib
 import flask
+import functools
+import gzip
+import html
+import os
 import pathlib
+import queue
+import re
+import string
 import subprocess
-import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not a POSIX system: edits rely on update_file's compare-and-swap alone.
+    fcntl = None
 
 import gitki.gitkitext as gitkitext
-from werkzeug.utils import xhtml
+from markupsafe import Markup, escape
+
+
+# Environment for every git invocation. Reads don't need git to take the
+# optional locks it would otherwise grab to refresh the index, and the C
+# locale skips loading translations. There's never anyone to answer a
+# credential prompt, so git must fail rather than wait for one. Python
+# opens its own files non-inheritable, so close_fds=False is safe and saves
+# the child from closing every possible descriptor after forking.
+GIT_ENV = {**os.environ, 'GIT_OPTIONAL_LOCKS': '0', 'LC_ALL': 'C',
+           'GIT_TERMINAL_PROMPT': '0'}
+
+# Same layout as the default `git show` output, with a marker line in front
+# of each commit so a whole `git log -p` can be split back up per commit.
+DIFF_MARKER = b'__GITKI__'
+DIFF_FORMAT = ('format:__GITKI__%H%n%C(yellow)commit %H%C(reset)%n'
+               'Author: %aN <%aE>%nDate:   %ad%n%n%w(0,4,4)%B%w(0,0,0)')
+
+TREE_ENTRY_TYPES = {'40000': 'tree', '160000': 'commit'}
+
+HISTORY_PAGE_SIZE = 100
+
+# Diffs bigger than this are cut short rather than rendered in full.
+MAX_DIFF_BYTES = 2 * 1024 * 1024
+
+# The "osx" terminal palette: 8 normal colors followed by 8 bright ones.
+ANSI_COLORS = (
+    '#000000', '#c23621', '#25bc24', '#adad27',
+    '#492ee1', '#d338d3', '#33bbc8', '#cbcccd',
+    '#404040', '#ff7661', '#65fc64', '#eded67',
+    '#896eff', '#ff78ff', '#73fbff', '#ffffff',
+)
+
+# One commit of Gitki.history's `git log --numstat` output.
+# Revisions and line counts are always hex and digits, so only the fields
+# that come from the commit itself need escaping.
+history_row = (
+    '<tr>'
+    '<td><a href="{page_url}">{short_rev}</a> <a href="{diff_url}">[diff]</a>'
+    '</td>'
+    '<td>{time}</td>'
+    '<td>{author}</td>'
+    '<td>{subject}</td>'
+    '<td>+{insertions} -{deletions}</td>'
+    '</tr>'
+).format
+
+csi_p = re.compile(r'\x1b\[([0-9;]*)([A-Za-z])')
 
 
 class NotFoundError(Exception):
@@ -13,10 +76,80 @@ class NotFoundError(Exception):
 
 
 def git_dir(path):
+    path = pathlib.Path(path)
+    # The usual layouts, a work tree or a bare repository, can be
+    # recognised without running git.
+    if (path / '.git' / 'HEAD').is_file():
+        return (path / '.git').resolve()
+    if (path / 'HEAD').is_file() and (path / 'objects').is_dir():
+        return path.resolve()
+
     result = subprocess.run(
         ['git', '-C', path, 'rev-parse', '--absolute-git-dir'],
-        stdout=subprocess.PIPE, check=True, encoding='utf-8')
-    return pathlib.Path(result.stdout)
+        stdout=subprocess.PIPE, check=True, encoding='utf-8', env=GIT_ENV,
+        close_fds=False)
+    return pathlib.Path(result.stdout.rstrip('\n'))
+
+
+def git_index_head(path, use_subprocess=False):
+    """Return the commit HEAD points to in the git directory at path."""
+    if use_subprocess:
+        result = subprocess.run(
+            ['git', '-C', path, 'log', '-n1', '--format=%H'],
+            stdout=subprocess.PIPE, check=True, encoding='utf-8',
+            env=GIT_ENV, close_fds=False)
+        return result.stdout.rstrip()
+
+    path = pathlib.Path(path)
+    with open(path / 'HEAD') as f:
+        head = f.read().strip()
+    if head.startswith('ref: '):
+        ref = head[len('ref: '):]
+        try:
+            with open(path / ref) as f:
+                head = f.read().strip()
+        except FileNotFoundError:
+            head = git_packed_ref(path, ref)
+    if not head or not all(c in string.hexdigits for c in head):
+        raise NotFoundError('Unable to read HEAD from {}.'.format(path))
+    return head
+
+
+def git_packed_ref(path, ref):
+    try:
+        with open(pathlib.Path(path) / 'packed-refs') as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                sha, _, name = line.rstrip('\n').partition(' ')
+                if name == ref:
+                    return sha
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # Git replaces ref files by renaming a lockfile over them, so the inode
+    # changes even when two updates land within the same mtime tick.
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def git_init(path, default_branch='main'):
@@ -24,194 +157,751 @@ def git_init(path, default_branch='main'):
     if not path.is_dir():
         path.mkdir(parents=True)
 
+    # Edits only ever move refs, nothing would keep a checkout up to date.
     subprocess.run(
         ['git', '-C', path,
-         '-c', 'init.defaultBranch={}'.format(default_branch), 'init'],
-        check=True)
-
-
-def git_index_head(index):
+         '-c', 'init.defaultBranch={}'.format(default_branch), 'init',
+         '--bare'],
+        check=True, env=GIT_ENV, close_fds=False)
+
+
+def git_config(index, key, value):
+    subprocess.run(['git', '-C', index, 'config', key, value], check=True,
+                   env=GIT_ENV, close_fds=False)
+
+
+def git_commit_graph_write_start(index):
+    # Changed-path Bloom filters need git 2.27 or newer.
+    return subprocess.Popen(
+        ['git', '-C', index, 'commit-graph', 'write', '--reachable',
+         '--changed-paths', '--split'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=GIT_ENV,
+        close_fds=False)
+
+
+def git_hash_object_start(index, contents):
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    proc = subprocess.Popen(
+        ['git', '-C', index, 'hash-object', '-w', '--stdin'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=GIT_ENV,
+        close_fds=False)
+    proc.stdin.write(contents)
+    proc.stdin.close()
+    return proc
+
+
+def git_hash_object_finish(proc):
+    stdout = proc.stdout.read()
+    proc.stdout.close()
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return stdout.decode('utf-8').rstrip()
+
+
+def git_mktree(index, entries):
+    tree = ''.join('{} {} {}\t{}\0'.format(mode, objtype, sha, name)
+                   for name, (mode, objtype, sha) in entries.items())
+    # Entries all come from an existing tree or were just hashed, so
+    # there's no need for git to look each of them up again.
     result = subprocess.run(
-        ['git', '-C', index, 'log', '-n1', '--format=%H'],
-        stdout=subprocess.PIPE, check=True, encoding='utf-8')
+        ['git', '-C', index, 'mktree', '-z', '--missing'],
+        input=tree, stdout=subprocess.PIPE, check=True, encoding='utf-8',
+        errors='surrogateescape', env=GIT_ENV, close_fds=False)
     return result.stdout.rstrip()
 
 
-def git_stage_changes(index, path, contents):
-    index = pathlib.Path(index)
-    fpath = index / path
-
-    mode = 'w'
-    if isinstance(contents, bytes):
-        mode = 'wb'
-
-    with open(fpath, mode) as f:
-        f.write(contents)
-
-    subprocess.run(['git', '-C', index, 'add', fpath], check=True)
-
-
-def git_remove(index, path):
-    index = pathlib.Path(index)
-    fpath = index / path
-
-    subprocess.run(['git', '-C', index, 'rm', fpath], check=True)
-
-
-def git_commit(index, message, author):
+def git_commit_tree(index, tree, parent, message, author):
     author_name, author_email = author
     env = {
+        **GIT_ENV,
         'GIT_AUTHOR_NAME': author_name,
         'GIT_AUTHOR_EMAIL': author_email,
     }
-    subprocess.run(['git', '-C', index, 'commit', '-m', message],
-                   env=env, check=True)
-    return git_index_head(index)
+    result = subprocess.run(
+        ['git', '-C', index, 'commit-tree', tree, '-p', parent,
+         '-m', message],
+        env=env, stdout=subprocess.PIPE, check=True, encoding='utf-8',
+        close_fds=False)
+    return result.stdout.rstrip()
 
 
-def git_cherry_pick(index, revision):
-    subprocess.run(['git', '-C', index, 'cherry-pick', revision], check=True)
-    return git_index_head(index)
+def git_merge_tree(index, branch1, branch2):
+    # --write-tree needs git 2.38 or newer.
+    result = subprocess.run(
+        ['git', '-C', index, 'merge-tree', '--write-tree', branch1, branch2],
+        stdout=subprocess.PIPE, check=True, encoding='utf-8', env=GIT_ENV,
+        close_fds=False)
+    return result.stdout.splitlines()[0]
 
 
-def git_reset(index, revision):
-    subprocess.run(['git', '-C', index, 'reset', '--hard', revision],
-                   check=True)
+def git_update_ref(index, ref, new_value, old_value):
+    subprocess.run(['git', '-C', index, 'update-ref', ref, new_value,
+                    old_value], check=True, env=GIT_ENV, close_fds=False)
 
 
-def git_log(index, revision='HEAD', path=None, numstat=False, format='%H%n'):
+def git_log(index, revision='HEAD', path=None, numstat=False, format='%H%n',
+            null_terminate=False, max_count=None, skip=None):
     args = ['git', '-C', index, 'log', '--format=tformat:{}'.format(format)]
+    if max_count is not None:
+        args.append('--max-count={}'.format(max_count))
+    if skip:
+        args.append('--skip={}'.format(skip))
+    if null_terminate:
+        args.append('-z')
     if numstat:
-        args.append('--numstat')
+        # Renames would add extra fields to the numstat lines.
+        args.extend(['--numstat', '--no-renames'])
     args.append(revision)
     if path:
         args.append('--')
         args.append(path)
-    result = subprocess.run(args, check=True, stdout=subprocess.PIPE,
-                            encoding='utf-8', errors='replace')
-    return result.stdout
-
+    with subprocess.Popen(args, stdout=subprocess.PIPE, env=GIT_ENV,
+                          close_fds=False) as proc:
+        yield from iter(lambda: proc.stdout.read1(65536), b'')
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+
+
+def git_relative_date(timestamp, now):
+    """Format a commit time the way git's --date=relative does."""
+    def ago(count, unit):
+        return '{} {}{} ago'.format(count, unit, '' if count == 1 else 's')
+
+    diff = int(now) - timestamp
+    if diff < 0:
+        return 'in the future'
+    if diff < 90:
+        return ago(diff, 'second')
+    diff = (diff + 30) // 60
+    if diff < 90:
+        return ago(diff, 'minute')
+    diff = (diff + 30) // 60
+    if diff < 36:
+        return ago(diff, 'hour')
+    diff = (diff + 12) // 24
+    if diff < 14:
+        return ago(diff, 'day')
+    if diff < 70:
+        return ago((diff + 3) // 7, 'week')
+    if diff < 365:
+        return ago((diff + 15) // 30, 'month')
+    if diff < 1825:
+        total_months = (diff * 12 * 2 + 365) // (365 * 2)
+        years, months = divmod(total_months, 12)
+        if months:
+            return '{} year{}, {}'.format(years, '' if years == 1 else 's',
+                                          ago(months, 'month'))
+        return ago(years, 'year')
+    return ago((diff + 183) // 365, 'year')
+
+
+def decode_diff(patch):
+    text = patch[:MAX_DIFF_BYTES].decode('utf-8', errors='replace')
+    if len(patch) > MAX_DIFF_BYTES:
+        # Cut at a line, git resets colors at the end of each one.
+        text = '{}\n[This diff is too large to show in full.]\n'.format(
+            text[:text.rfind('\n') + 1])
+    return text
+
+
+def git_show(index, revision):
+    args = ['git', '-C', index, 'show', '--color=always', revision]
+    with subprocess.Popen(args, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, env=GIT_ENV,
+                          close_fds=False) as proc:
+        # Don't read (or wait for git to produce) more than will be shown.
+        patch = proc.stdout.read(MAX_DIFF_BYTES + 1)
+        if len(patch) > MAX_DIFF_BYTES:
+            proc.kill()
+        elif proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, args)
+    return decode_diff(patch)
+
+
+@functools.lru_cache(maxsize=None)
+def sgr_style(params):
+    """Translate SGR parameters (e.g. "1;31") to an inline CSS style."""
+    styles = {}
+    reverse = False
+    codes = iter(int(code) if code else 0 for code in params.split(';'))
+    for code in codes:
+        if code == 0:
+            styles.clear()
+            reverse = False
+        elif code == 1:
+            styles['font-weight'] = 'bold'
+        elif code == 2:
+            styles['opacity'] = '0.7'
+        elif code == 3:
+            styles['font-style'] = 'italic'
+        elif code == 4:
+            styles['text-decoration'] = 'underline'
+        elif code == 7:
+            reverse = True
+        elif code == 22:
+            styles.pop('font-weight', None)
+            styles.pop('opacity', None)
+        elif code == 23:
+            styles.pop('font-style', None)
+        elif code == 24:
+            styles.pop('text-decoration', None)
+        elif code == 27:
+            reverse = False
+        elif code == 39:
+            styles.pop('color', None)
+        elif code == 49:
+            styles.pop('background-color', None)
+        elif 30 <= code <= 37:
+            styles['color'] = ANSI_COLORS[code - 30]
+        elif 90 <= code <= 97:
+            styles['color'] = ANSI_COLORS[code - 82]
+        elif 40 <= code <= 47:
+            styles['background-color'] = ANSI_COLORS[code - 40]
+        elif 100 <= code <= 107:
+            styles['background-color'] = ANSI_COLORS[code - 92]
+        elif code in (38, 48):
+            # Extended colors: only the 16 palette entries are supported,
+            # but the extra parameters must be skipped either way.
+            kind = next(codes, None)
+            if kind == 5:
+                index = next(codes, 0)
+                if index < len(ANSI_COLORS):
+                    key = 'color' if code == 38 else 'background-color'
+                    styles[key] = ANSI_COLORS[index]
+            elif kind == 2:
+                for _ in range(3):
+                    next(codes, None)
+    if reverse:
+        color = styles.get('color', '#000000')
+        styles['color'] = styles.get('background-color', '#ffffff')
+        styles['background-color'] = color
+    return '; '.join('{}: {}'.format(k, v) for k, v in styles.items())
+
+
+@functools.lru_cache(maxsize=None)
+def sgr_span(params):
+    return '<span style="{}">'.format(sgr_style(params))
+
+
+def ansi_to_html(text):
+    active = []
+
+    def replace(m):
+        params, command = m.groups()
+        if command != 'm':
+            return ''
+        if params in ('', '0'):
+            if active:
+                active.clear()
+                return '</span>'
+            return ''
+        if active:
+            active.append(params)
+            return '</span>' + sgr_span(';'.join(active))
+        # git resets at the end of every line, so this is the common case.
+        active.append(params)
+        return sgr_span(params)
+
+    body = csi_p.sub(replace, html.escape(text, quote=False))
+    if active:
+        body += '</span>'
+    return ('<pre style="white-space: pre-wrap; word-wrap: break-word;">'
+            '{}</pre>'.format(body))
+
+
+class LRUCache:
+    """An LRU cache bounded by entry count and, optionally, by total len()."""
+    def __init__(self, maxsize, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if self.maxbytes is not None:
+                old = self.data.get(key)
+                self.size += len(value) - (len(old) if old else 0)
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize or (
+                    self.maxbytes is not None and self.size > self.maxbytes):
+                _, evicted = self.data.popitem(last=False)
+                if self.maxbytes is not None:
+                    self.size -= len(evicted)
+
+
+class CatFileBatch:
+    def __init__(self, repo):
+        self.repo = repo
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            ['git', '-C', self.repo, 'cat-file', '--batch'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=GIT_ENV,
+            close_fds=False)
+
+    def close(self):
+        if not self.proc:
+            return
+        proc, self.proc = self.proc, None
+        proc.kill()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.stdout.close()
+        proc.wait()
+
+    def request(self, line):
+        if not self.proc or self.proc.poll() is not None:
+            self.start()
+        try:
+            self.proc.stdin.write(line)
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            # The process went away since our last request, try once more
+            # with a fresh one.
+            self.close()
+            self.start()
+            self.proc.stdin.write(line)
+            self.proc.stdin.flush()
+
+    def read_object(self, obj):
+        if '\n' in obj:
+            raise NotFoundError('Invalid object name: {!r}.'.format(obj))
+
+        line = '{}\n'.format(obj).encode('utf-8')
+        try:
+            self.request(line)
+            header = self.proc.stdout.readline()
+            if not header:
+                # The process exited before answering, which can happen
+                # if it died after our liveness check.  Retry once.
+                self.close()
+                self.request(line)
+                header = self.proc.stdout.readline()
+            if not header:
+                raise subprocess.CalledProcessError(
+                    self.proc.wait(), self.proc.args)
+            # git echoes the name back for these, and it may have spaces.
+            if header.rstrip().endswith((b' missing', b' ambiguous')):
+                raise NotFoundError('No such object: {}.'.format(obj))
+            sha, objtype, size = header.decode('utf-8').rsplit(None, 2)
+            # Each object is followed by a newline, which we need to consume.
+            contents = self.proc.stdout.read(int(size) + 1)[:-1]
+        except NotFoundError:
+            raise
+        except BaseException:
+            # Don't leave the pipe with a partially consumed response.
+            self.close()
+            raise
+        return sha, objtype, contents
+
+    def resolve(self, revision):
+        try:
+            sha, _, _ = self.read_object('{}^{{commit}}'.format(revision))
+        except NotFoundError:
+            raise NotFoundError(
+                'The revision {} does not exist.'.format(revision))
+        return sha
+
+    def ls_tree(self, revision):
+        sha, _, tree = self.read_object('{}^{{tree}}'.format(revision))
+        hash_size = len(sha) // 2
+        entries = {}
+        pos = 0
+        # Each tree entry is "<mode> <name>\0<binary object id>".
+        while pos < len(tree):
+            space = tree.index(b' ', pos)
+            nul = tree.index(b'\0', space)
+            mode = tree[pos:space].decode('ascii')
+            name = tree[space + 1:nul].decode('utf-8',
+                                              errors='surrogateescape')
+            pos = nul + 1 + hash_size
+            entries[name] = (mode, TREE_ENTRY_TYPES.get(mode, 'blob'),
+                             tree[nul + 1:pos].hex())
+        return entries
+
+    def get(self, revision, name):
+        try:
+            _, _, contents = self.read_object(
+                '{}:{}'.format(revision, name))
+        except NotFoundError:
+            raise NotFoundError(
+                'The file {} does not exist at revision {}.'.format(
+                    name, revision))
+        return contents
 
-def make_table(rows, headers=None):
-    fmt_rows = []
-    if headers:
-        fmt_rows.append(xhtml.tr(*map(xhtml.th, headers)))
-    for row in rows:
-        fmt_rows.append(xhtml.tr(*map(xhtml.td, row)))
-    return xhtml.table(*fmt_rows)
 
+class CatFilePool:
+    """Long-running cat-file processes shared by the request threads.
 
-class GitWorktree(tempfile.TemporaryDirectory):
-    def __init__(self, repo, *args, revision='HEAD', **kwargs):
+    Each request borrows a process for the duration of one call, so
+    concurrent requests never interleave on the same pipe.
+    """
+    def __init__(self, repo, size=4):
         self.repo = repo
-        self.revision = revision
-        super().__init__(*args, **kwargs)
+        self.size = size
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def prewarm(self):
+        while not self.idle.full():
+            cat_file = CatFileBatch(self.repo)
+            cat_file.start()
+            self.idle.put_nowait(cat_file)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        if self.pid != os.getpid():
+            # Forked since the pool was filled: those pipes belong to the
+            # parent process.
+            self.pid = os.getpid()
+            self.idle = queue.LifoQueue(maxsize=self.size)
+
+        try:
+            cat_file = self.idle.get_nowait()
+        except queue.Empty:
+            cat_file = CatFileBatch(self.repo)
+        try:
+            yield cat_file
+        finally:
+            try:
+                self.idle.put_nowait(cat_file)
+            except queue.Full:
+                cat_file.close()
 
-    def __enter__(self):
-        self.wt_dir = pathlib.Path(super().__enter__())
-        subprocess.run(
-            ['git', '-C', self.repo, 'worktree', 'add', '-d', self.wt_dir,
-             self.revision],
-            check=True)
-        return self.wt_dir
+    def resolve(self, revision):
+        with self.acquire() as cat_file:
+            return cat_file.resolve(revision)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        subprocess.run(
-            ['git', '-C', self.repo, 'worktree', 'remove', self.wt_dir],
-            check=True)
-        super().__exit__(exc_type, exc_val, exc_tb)
+    def ls_tree(self, revision):
+        with self.acquire() as cat_file:
+            return cat_file.ls_tree(revision)
+
+    def get(self, revision, name):
+        with self.acquire() as cat_file:
+            return cat_file.get(revision, name)
 
 
 class Gitki:
-    def __init__(self, repo):
+    def __init__(self, repo, cat_file_processes=4):
         self.repo = pathlib.Path(repo)
         try:
-            git_dir(self.repo)
+            self.git_dir = git_dir(self.repo)
         except subprocess.CalledProcessError:
             git_init(self.repo)
+            self.git_dir = git_dir(self.repo)
+        self.cat_file = CatFilePool(self.repo, size=cat_file_processes)
+        # Once a commit-graph chain exists, this has been done before.
+        if not (self.git_dir / 'objects' / 'info' / 'commit-graphs'
+                / 'commit-graph-chain').exists():
+            git_config(self.repo, 'core.commitGraph', 'true')
+            git_config(self.repo, 'gc.writeCommitGraph', 'true')
+        self._commit_graph = None
+        self.refresh_commit_graph()
+        self._head_cache = (None, None)
+        # Rendered pages are keyed by commit sha, so entries never go stale.
+        self._render_page_at = functools.lru_cache(maxsize=2048)(
+            self._render_page_at)
+        # Diffs can be up to MAX_DIFF_BYTES each (more once rendered), so
+        # these are bounded by total size too.
+        self._rendered_diffs = LRUCache(maxsize=64, maxbytes=32 * 1024 * 1024)
+        self._diffs = LRUCache(maxsize=256, maxbytes=32 * 1024 * 1024)
+        # History only changes when HEAD does, so it is keyed by both.
+        self._history = LRUCache(maxsize=128)
+
+    def _head_key(self):
+        with open(self.git_dir / 'HEAD') as f:
+            head = f.read().strip()
+        ref_path = None
+        if head.startswith('ref: '):
+            ref_path = self.git_dir / head[len('ref: '):]
+        return (head, ref_path and file_stamp(ref_path),
+                file_stamp(self.git_dir / 'packed-refs'))
 
     @property
     def index_head(self):
-        return git_index_head(self.repo)
+        # Only look HEAD up again when one of the files it is read from
+        # changes, which is a couple of stats rather than a git process.
+        key = self._head_key()
+        cached_key, sha = self._head_cache
+        if key == cached_key:
+            return sha
 
-    def get_contents_at_revision(self, name, revision='HEAD', encoding='utf-8'):
         try:
-            result = subprocess.run(
-                ['git', '-C', self.repo, 'show', '{}:{}'.format(revision, name)],
-                stdout=subprocess.PIPE, check=True, encoding=encoding,
-                errors='replace')
-        except subprocess.CalledProcessError:
-            raise NotFoundError(
-                'The file {} does not exist at revision {}.'.format(
-                    name, revision))
-        return result.stdout
+            sha = git_index_head(self.git_dir)
+        except NotFoundError:
+            # Refs stored some other way (a linked worktree's common dir,
+            # reftable): let git sort it out.  The files above don't change
+            # when those refs do, so this can't be cached against them.
+            return self.cat_file.resolve('HEAD')
+        self._head_cache = (key, sha)
+        return sha
+
+    def refresh_commit_graph(self):
+        # Path limited logs (history, diffs) can skip commits that don't
+        # touch the page using the commit-graph's Bloom filters, if they
+        # are kept up to date.  Writing them is left running in the
+        # background, one at a time.
+        if self._commit_graph and self._commit_graph.poll() is None:
+            return
+        self._commit_graph = git_commit_graph_write_start(self.repo)
 
-    def render_page(self, name, revision='HEAD'):
+    def get_contents_at_revision(self, name, revision='HEAD', encoding='utf-8'):
+        contents = self.cat_file.get(revision, name)
+        return contents.decode(encoding, errors='replace')
+
+    def resolve_revision(self, revision):
+        if revision == 'HEAD':
+            return self.index_head
+        return self.cat_file.resolve(revision)
+
+    def _render_page_at(self, name, sha):
         page_raw = self.get_contents_at_revision('{}.txt'.format(name),
-                                                 revision=revision)
+                                                 revision=sha)
 
         return name, gitkitext.to_html(gitkitext.parse(page_raw))
 
-    def history(self, name, revision='HEAD'):
-        log = iter(git_log(self.repo, revision=revision, path=name,
-                           format='%H%n%cr%n%aN <%aE>%n%s', numstat=True)
-                   .splitlines())
-        while True:
-            try:
-                rev = next(log).rstrip()
-            except StopIteration:
-                return
-            time = next(log).rstrip()
-            author = next(log).rstrip()
-            subject = next(log).rstrip()
-            blank = next(log)
-            insertions, deletions, *files = next(log).split()
-
-            yield rev, time, author, subject, int(insertions), int(deletions)
+    def render_page(self, name, revision='HEAD', sha=None):
+        # Callers that already resolved the revision pass its sha along,
+        # which keeps a cache hit free of git round trips.
+        if sha is None:
+            sha = self.resolve_revision(revision)
+        try:
+            return self._render_page_at(name, sha)
+        except NotFoundError:
+            raise NotFoundError(
+                'The file {}.txt does not exist at revision {}.'.format(
+                    name, revision))
 
-    def worktree(self, revision='HEAD'):
-        return GitWorktree(self.repo, revision=revision)
+    def _read_history(self, name, revision, limit, skip):
+        def decode(field):
+            return field.decode('utf-8', errors='replace')
+
+        def count(field):
+            # Binary files have "-" for their line counts.
+            return int(field) if field.isdigit() else 0
+
+        # Each commit comes out as five NUL terminated fields: the four
+        # from the format, then "\n<insertions>\t<deletions>\t<path>".
+        log = git_log(self.repo, revision=revision, path=name,
+                      format='%H%x00%ct%x00%aN <%aE>%x00%s', numstat=True,
+                      null_terminate=True, max_count=limit, skip=skip)
+        entries = []
+        fields = []
+        pending = b''
+        for chunk in log:
+            # Keep any partially received field for the next chunk.
+            *complete, pending = (pending + chunk).split(b'\0')
+            fields.extend(complete)
+            end = len(fields) - len(fields) % 5
+            # Walk the complete entries five fields at a time.
+            field = iter(fields[:end])
+            for rev, timestamp, author, subject, numstat in zip(
+                    field, field, field, field, field):
+                insertions, deletions, _ = numstat.split(None, 2)
+                entry = (rev.decode('ascii'), int(timestamp), decode(author),
+                         decode(subject), count(insertions), count(deletions))
+                entries.append(entry)
+                yield entry
+            del fields[:end]
+        self._history.put((name, revision, limit, skip), entries)
+
+    def history(self, name, revision='HEAD', limit=None, skip=0):
+        revision = self.resolve_revision(revision)
+        entries = self._history.get((name, revision, limit, skip))
+        if entries is None:
+            entries = self._read_history(name, revision, limit, skip)
+
+        # Relative times are not cached, they change even when HEAD doesn't.
+        now = time.time()
+        for rev, timestamp, author, subject, insertions, deletions in entries:
+            yield (rev, git_relative_date(timestamp, now), author, subject,
+                   insertions, deletions)
+
+    def walk_with_diffs(self, name, revision='HEAD', max_count=32):
+        """Load the diffs of recent commits to a file with a single git log."""
+        args = ['git', '-C', self.repo, 'log', '--color=always', '--cc',
+                '--full-diff', '--pretty={}'.format(DIFF_FORMAT),
+                '--max-count={}'.format(max_count), revision, '--', name]
+        sha = None
+        with subprocess.Popen(args, stdout=subprocess.PIPE, env=GIT_ENV,
+                              close_fds=False) as proc:
+            for line in proc.stdout:
+                if line.startswith(DIFF_MARKER):
+                    if sha:
+                        if not truncated:
+                            # Drop the blank line git puts between commits.
+                            patch.pop()
+                        self._diffs.put(sha, decode_diff(b''.join(patch)))
+                    sha = line[len(DIFF_MARKER):].rstrip().decode('utf-8')
+                    patch = []
+                    size = 0
+                    truncated = False
+                elif size <= MAX_DIFF_BYTES:
+                    patch.append(line)
+                    size += len(line)
+                else:
+                    # What was kept is already over the limit, so
+                    # decode_diff will add the note.
+                    truncated = True
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        if sha:
+            self._diffs.put(sha, decode_diff(b''.join(patch)))
+
+    def get_diff(self, sha):
+        patch = self._diffs.get(sha)
+        if patch is None:
+            patch = git_show(self.repo, sha)
+            self._diffs.put(sha, patch)
+        return patch
+
+    def _render_diff_at(self, sha):
+        html = self._rendered_diffs.get(sha)
+        if html is None:
+            html = ansi_to_html(self.get_diff(sha))
+            self._rendered_diffs.put(sha, html)
+        return html
+
+    def render_diff(self, revision, name=None):
+        sha = self.resolve_revision(revision)
+        if name and sha not in self._diffs:
+            # Coming from a history page, so the neighbouring diffs are
+            # likely to be asked for next.
+            self.walk_with_diffs(name, revision=sha)
+        return self._render_diff_at(sha)
 
     def update_file(self, name, author, contents, revision='HEAD',
                     message=None):
-        with self.worktree(revision=revision) as worktree:
-            if contents is None:
-                git_remove(worktree, name)
-            else:
-                git_stage_changes(worktree, name, contents)
-
-            if not message:
-                message = 'Update {}'.format(name)
-
-            new_rev = git_commit(worktree, message, author)
-
-            # First rebase on main index to shake out merge conflicts
-            git_reset(worktree, self.index_head)
-            new_rev = git_cherry_pick(worktree, new_rev)
-
-            # Next, submit into the main index
-            git_cherry_pick(self.repo, new_rev)
-
-    def template(self, title, body):
-        return xhtml.html(
-            xhtml.head(
-                xhtml.title(xhtml(title)),
-            ),
-            xhtml.body(
-                xhtml.h1(xhtml(title)),
-                xhtml.div(body),
-                xhtml.footer(
-                    'Powered by Gitki ',
-                    xhtml.a('[preferences]', href=flask.url_for('preferences')),
-                ),
-            ),
-        )
+        if not message:
+            message = 'Update {}'.format(name)
+
+        # Build the commit directly in the object database, no checkout
+        # needed.  Only HEAD is moved: if the wiki is a non-bare
+        # repository, its index and work tree are left behind and must not
+        # be committed from.
+        hashing = None
+        if contents is not None:
+            # Let git hash and store the new blob while we read the tree.
+            hashing = git_hash_object_start(self.repo, contents)
+        try:
+            parent = self.resolve_revision(revision)
+            tree = self.cat_file.ls_tree(parent)
+        finally:
+            if hashing:
+                blob = git_hash_object_finish(hashing)
+
+        if contents is None:
+            if tree.pop(name, None) is None:
+                raise NotFoundError(
+                    'The file {} does not exist at revision {}.'.format(
+                        name, revision))
+        elif tree.get(name) == ('100644', 'blob', blob):
+            # Saving a page unchanged would only make an empty commit.
+            return parent
+        else:
+            tree[name] = ('100644', 'blob', blob)
+        new_rev = git_commit_tree(self.repo, git_mktree(self.repo, tree),
+                                  parent, message, author)
+
+        # Serialize edits from all workers, so the compare-and-swap below
+        # only has to retry for writers from outside of Gitki.
+        with file_lock(self.git_dir / 'gitki.lock'):
+            while True:
+                head = self.index_head
+                if head != parent:
+                    # The wiki moved on since the edit started, replay our
+                    # change on top of it like a cherry-pick would.
+                    new_rev = git_commit_tree(
+                        self.repo, git_merge_tree(self.repo, head, new_rev),
+                        head, message, author)
+                    parent = head
+                try:
+                    git_update_ref(self.repo, 'HEAD', new_rev, head)
+                except subprocess.CalledProcessError:
+                    if self.index_head == head:
+                        raise
+                    # Lost a race with a concurrent edit, try again.
+                    continue
+                # Writers from outside of Gitki don't take our lock, so the
+                # ref files may already hold something else: look again.
+                self._head_cache = (None, None)
+                break
+
+        self.refresh_commit_graph()
+        return new_rev
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            # Flush every chunk so streamed pages still render as they
+            # arrive.
+            yield (compressor.compress(chunk)
+                   + compressor.flush(zlib.Z_SYNC_FLUSH))
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or flask.request.accept_encodings['gzip'] <= 0):
+        return response
+
+    if response.is_streamed:
+        response.response = gzip_stream(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < 512:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
 
 def build_app(config):
     app = flask.Flask(__name__)
     app.config.from_mapping(config)
 
-    gitki = Gitki(app.config['GITKI_HOME'])
+    # Requests spend their time waiting on git with the GIL released, so
+    # they scale with threads (e.g. gunicorn -k gthread), as long as there
+    # is a cat-file process for each thread.
+    gitki = Gitki(app.config['GITKI_HOME'],
+                  cat_file_processes=app.config.get(
+                      'GITKI_CAT_FILE_PROCESSES', 4))
+    gitki.cat_file.prewarm()
+    app.after_request(compress_response)
+
+    def stream_template(template_name, **context):
+        app.update_template_context(context)
+        stream = app.jinja_env.get_template(template_name).stream(context)
+        stream.enable_buffering()
+        return flask.Response(flask.stream_with_context(stream))
 
     @app.route('/preferences', methods=['POST'])
     def preferences_save():
@@ -235,56 +925,12 @@ def build_app(config):
 
     @app.route('/preferences', methods=['GET'])
     def preferences():
-        def input_options_from_cookie(cookie):
-            value = flask.request.cookies.get(cookie)
-            options = {'name': cookie}
-            if value:
-                options['value'] = value
-            return options
-
-        edit = flask.request.args.get('edit')
-        if edit:
-            edit_input = xhtml.input(
-                type='hidden',
-                name='edit',
-                value=edit)
-            edit_message = xhtml.div(
-                'You must set author information before editing a page.')
-        else:
-            edit_input = ''
-            edit_message = ''
-
-        return gitki.template(
-            'Gitki Preferences',
-            xhtml.div(
-                edit_message,
-                xhtml.form(
-                    edit_input,
-                    xhtml.div(
-                        xhtml.h2('Git Author'),
-                        xhtml.div(
-                            xhtml.label('Full Name'),
-                            xhtml.input(
-                                type='text',
-                                **input_options_from_cookie(
-                                    'gitki_author_name')),
-                        ),
-                        xhtml.div(
-                            xhtml.label('Email Address'),
-                            xhtml.input(
-                                type='email',
-                                **input_options_from_cookie(
-                                    'gitki_author_email')),
-                        ),
-                    ),
-                    xhtml.button(
-                        'Save Preferences',
-                        type='submit'),
-                    method='POST',
-                    action=flask.url_for('preferences_save'),
-                ),
-            ),
-        )
+        return flask.render_template(
+            'preferences.html',
+            title='Gitki Preferences',
+            edit=flask.request.args.get('edit'),
+            author_name=flask.request.cookies.get('gitki_author_name'),
+            author_email=flask.request.cookies.get('gitki_author_email'))
 
     @app.route('/page/<name>/edit', methods=['POST'])
     def edit_submit(name):
@@ -323,108 +969,91 @@ def build_app(config):
             page_contents = ''
             default_message = 'Created new page {}'.format(name)
 
-        return gitki.template(
-            'Editing {}'.format(name),
-            xhtml.form(
-                xhtml.input(type='hidden', name='revision', value=revision),
-                xhtml.input(type='hidden', name='author_name',
-                            value=author_name),
-                xhtml.input(type='hidden', name='author_email',
-                            value=author_email),
-                xhtml.textarea(page_contents, name='contents',
-                               rows='48', cols='80'),
-                xhtml.div(xhtml(
-                    'Editing as {} <{}>'.format(author_name, author_email))),
-                xhtml.div(
-                    xhtml.label('Describe your changes'),
-                    xhtml.input(type='text', name='message',
-                                value=default_message),
-                ),
-                xhtml.button('Save Changes', type='submit'),
-                method='POST',
-                action=flask.url_for('edit_submit', name=name),
-            ),
-        )
+        return flask.render_template(
+            'edit.html',
+            title='Editing {}'.format(name),
+            name=name,
+            revision=revision,
+            author_name=author_name,
+            author_email=author_email,
+            contents=page_contents,
+            message=default_message)
 
     @app.route('/', defaults={'name': 'FrontPage'})
     @app.route('/page/<name>', methods=['GET'])
     def page(name):
         revision = flask.request.args.get('revision', 'HEAD')
         try:
-            header, body = gitki.render_page(name, revision=revision)
+            sha = gitki.resolve_revision(revision)
+        except NotFoundError:
+            sha = None
+
+        # A page is fixed by the commit it's rendered from.  The tag is
+        # weak, as the body may be gzipped on the way out.
+        if sha and flask.request.if_none_match.contains_weak(sha):
+            response = flask.Response(status=304)
+            response.set_etag(sha, weak=True)
+            return response
+
+        try:
+            header, body = gitki.render_page(name, revision=revision,
+                                             sha=sha)
+            error = None
         except NotFoundError as e:
             header = 'New Page'
-            body = xhtml.p(
-                str(e),
-                xhtml.span(' Do you want to ',
-                           xhtml.a('create it?',
-                                   href=flask.url_for('edit', name=name))))
-
-        return gitki.template(
-            header,
-            xhtml.div(
-                xhtml.div(
-                    xhtml.a('[edit]',
-                            href=flask.url_for('edit', name=name)),
-                    xhtml.a('[history]',
-                            href=flask.url_for('history', name=name)),
-                ),
-                body))
+            body = None
+            error = str(e)
+
+        response = flask.make_response(flask.render_template(
+            'page.html', title=header, name=name, body=body, error=error))
+        if sha:
+            response.set_etag(sha, weak=True)
+        return response
 
     @app.route('/diff/<rev>', methods=['GET'])
     def diff(rev):
         try:
-            result = subprocess.run(
-                ['git', '-C', gitki.repo, 'show', '--color=always', rev],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
-                encoding='utf-8', errors='replace')
-        except subprocess.CalledProcessError:
+            html = gitki.render_diff(rev, name=flask.request.args.get('name'))
+        except (NotFoundError, subprocess.CalledProcessError):
             flask.abort(404, 'Unknown revision.')
-        converter = ansi2html.Ansi2HTMLConverter(
-            dark_bg=False,
-            inline=True,
-            scheme='osx',
-        )
-        html = converter.convert(result.stdout)
-        # ugly ... :(
-        html = html.replace('#AAAAAA', '#FFFFFF', 1)
-        return gitki.template('Diff Output', html)
+        return flask.render_template('diff.html', title='Diff Output',
+                                     diff=html)
 
     @app.route('/page/<name>/history', methods=['GET'])
     def history(name):
-        rows = []
-        for revision, time, author, subject, cins, cdel in gitki.history(
-                '{}.txt'.format(name)):
-            changes = '+{} -{}'.format(cins, cdel)
-            rows.append([
-                xhtml.span(
-                    xhtml.a(
-                        revision[:6],
-                        href=(flask.url_for('page', name=name)
-                              + '?revision={}'.format(revision))),
-                    ' ',
-                    xhtml.a('[diff]', href=flask.url_for('diff', rev=revision)),
-                ),
-                xhtml(time),
-                xhtml(author),
-                xhtml(subject),
-                xhtml(changes),
-            ])
-
-        return gitki.template(
-            '{} History'.format(name),
-            xhtml.div(
-                xhtml.div(
-                    xhtml.a(
-                        '[Back to page]',
-                        href=flask.url_for('page', name=name),
-                    ),
-                ),
-                make_table(
-                    rows,
-                    headers=('Revision', 'Commit Time', 'Author',
-                             'Description', 'Delta')),
-            ),
-        )
+        page = max(flask.request.args.get('page', 0, type=int), 0)
+
+        # The links in each row only differ by revision, which is plain
+        # hex, so build the URLs around it once rather than per row.  The
+        # revision is the last part of the page URL and the first variable
+        # part of the diff URL.
+        marker = '__GITKI_REV__'
+        page_url = escape(flask.url_for(
+            'page', name=name, revision=marker)).rsplit(marker, 1)
+        diff_url = escape(flask.url_for(
+            'diff', rev=marker, name='{}.txt'.format(name))).split(marker, 1)
+
+        def rows():
+            for revision, time, author, subject, cins, cdel in gitki.history(
+                    '{}.txt'.format(name), limit=HISTORY_PAGE_SIZE,
+                    skip=page * HISTORY_PAGE_SIZE):
+                yield Markup(history_row(
+                    page_url=revision.join(page_url),
+                    short_rev=revision[:6],
+                    diff_url=revision.join(diff_url),
+                    time=escape(time),
+                    author=escape(author),
+                    subject=escape(subject),
+                    insertions=cins,
+                    deletions=cdel))
+
+        # Rows are rendered as git log produces them.
+        return stream_template(
+            'history.html',
+            title='{} History'.format(name),
+            name=name,
+            page=page,
+            page_size=HISTORY_PAGE_SIZE,
+            rows=rows())
 
     return app
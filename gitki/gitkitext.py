@@ -1,32 +1,32 @@
 import flask
-import werkzeug
+import functools
 import re
 
+from markupsafe import Markup, escape
 
-token_p = re.compile(r'''
-    (   (?P<StartHeader>^::[ \t]+)
-    |   (?P<Link><[^>]+>)
-    |   (?P<BlankLine>^[ \t]*$)
-    |   (?P<Text>[^<\n]+)
-    |   (?P<Newline>\n)
-    |   (?P<FAIL>.)
-    )
-''', re.VERBOSE | re.MULTILINE)
+
+# Blank lines take their newline with them, so that no token is ever empty
+# (the scanner stops at an empty match).
+token_scanner = re.Scanner([
+    (r'^::[ \t]+', lambda scanner, source: ('StartHeader', source)),
+    (r'<[^>]+>', lambda scanner, source: ('Link', source)),
+    (r'^[ \t]*(?:\n|\Z)', lambda scanner, source: ('BlankLine', source)),
+    (r'[^<\n]+', lambda scanner, source: ('Text', source)),
+    (r'\n', lambda scanner, source: ('Newline', source)),
+], re.MULTILINE)
 
 
 def tokenize(text):
-    text = text.replace('\r', '')
-    for m in token_p.finditer(text):
-        d = {k: v for k, v in m.groupdict().items() if v is not None}
-        typename, source = d.popitem()
-        assert not d
-        if typename == 'FAIL':
-            raise ValueError('Malformed input: {}'.format(source))
-        yield typename, source
+    tokens, rest = token_scanner.scan(text.replace('\r', ''))
+    if rest:
+        raise ValueError('Malformed input: {}'.format(rest[0]))
+    return tokens
 
 
 def parse(text):
-    stack = [('Par', ())]
+    # Spans, paragraphs and headers are built up in place as lists, and
+    # only turned into tuples once they are complete.
+    stack = [['Par', []]]
 
     def match(*types):
         top_of_stack = stack[-len(types):]
@@ -49,77 +49,74 @@ def parse(text):
 
         while True:
             if match('Text'):
-                item = stack.pop()
-                stack.append(('Span', (item, )))
+                stack[-1] = ['Span', [stack[-1]]]
             elif match('Link'):
-                _, linktext = stack.pop()
-                stack.append(('Span', (parselink(linktext), )))
+                _, linktext = stack[-1]
+                stack[-1] = ['Span', [parselink(linktext)]]
             elif match('Span', 'Span'):
-                _, span2 = stack.pop()
-                _, span1 = stack.pop()
-                stack.append(('Span', span1 + span2))
+                _, span = stack.pop()
+                stack[-1][1].extend(span)
             elif match('Par', 'Span'):
                 _, span = stack.pop()
-                _, par = stack.pop()
-                stack.append(('Par', par + span))
+                stack[-1][1].extend(span)
             elif match('Par', 'Newline', 'Span'):
                 _, span = stack.pop()
                 stack.pop()
-                _, par = stack.pop()
+                _, par = stack[-1]
                 if par:
-                    textparts = (('Text', ' '), )
-                else:
-                    textparts = ()
-                stack.append(('Par', par + textparts + span))
+                    par.append(('Text', ' '))
+                par.extend(span)
             elif match('StartHeader'):
-                stack.pop()
-                stack.append(('Header', ()))
+                stack[-1] = ['Header', []]
             elif match('Header', 'Span'):
                 _, span = stack.pop()
-                _, header = stack.pop()
-                stack.append(('Header', header + span))
+                stack[-1][1].extend(span)
             elif match('Header', 'Newline'):
-                stack.pop()
-                stack.append(('Par', ()))
+                stack[-1] = ['Par', []]
             elif match('BlankLine'):
-                stack.pop()
-                stack.append(('Par', ()))
+                stack[-1] = ['Par', []]
             else:
                 break
 
     for part in stack:
-        if part == ('Par', ()):
+        if part == ['Par', []]:
             continue
         if part[0] == 'Newline':
             continue
-        yield part
+        part_type, parts = part
+        yield (part_type, tuple(parts))
 
 
-def to_html(parse_result, dialect='xhtml', url_for=flask.url_for):
+def to_html(parse_result, url_for=flask.url_for):
     """Convert parsed GitkiText to HTML."""
-    html_builder = werkzeug.utils.HTMLBuilder(dialect)
+    # Pages tend to link to the same few pages over and over, only build
+    # each of those URLs once.
+    @functools.lru_cache(maxsize=None)
+    def page_url(document):
+        return escape(url_for('page', name=document))
+
+    def parts_to_html(parts):
+        return ''.join(part_to_html(part) for part in parts)
 
     def part_to_html(part):
         part_type, *args = part
         if part_type == 'Text':
-            return html_builder(args[0])
+            return escape(args[0])
         if part_type == 'InternalLink':
             document, link_content = args
-            return html_builder.a(
-                *(part_to_html(part) for part in link_content),
-                href=url_for('page', name=document))
+            return '<a href="{}">{}</a>'.format(
+                page_url(document), parts_to_html(link_content))
         if part_type == 'ExternalLink':
             uri, link_content = args
-            return html_builder.a(
-                *(part_to_html(part) for part in link_content),
-                href=uri, target='_blank')
+            return '<a href="{}" target="_blank">{}</a>'.format(
+                escape(uri), parts_to_html(link_content))
         if part_type == 'Header':
-            return html_builder.h2(*(part_to_html(part) for part in args[0]))
+            return '<h2>{}</h2>'.format(parts_to_html(args[0]))
         if part_type == 'Par':
-            return html_builder.p(*(part_to_html(part) for part in args[0]))
+            return '<p>{}</p>'.format(parts_to_html(args[0]))
         raise ValueError('Unknown part type: {}'.format(part_type))
 
-    return html_builder.div(*(part_to_html(part) for part in parse_result))
+    return Markup('<div>{}</div>'.format(parts_to_html(parse_result)))
 
 
 def unparse(parse_result, cols=79):
@@ -16,11 +16,14 @@ setuptools.setup(
 
     keywords='wiki',
     packages=setuptools.find_packages('gitki'),
+    package_data={'gitki': ['templates/*.html']},
 
+    # Gitki also runs git itself, which needs to be version 2.38 or newer
+    # (for merge-tree --write-tree).
     python_requires='>=3.6, <4',
     install_requires=[
-        'ansi2html>=1.6',
         'flask>=1.1',
+        'markupsafe>=1.0',
         'werkzeug>=1.0',
     ],
 )